@@ -1,11 +1,22 @@
 # -*- coding: utf-8 -*-
 import streamlit as st
 import pandas as pd
-from supabase import create_client, Client
+import numpy as np
+from supabase import Client
+from supabase_client import get_supabase, get_user_db
+from formatting import format_currency, format_percentage
 import math
-import datetime
+import time
+import io
+import os
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import traceback # For more detailed error logging if needed
 
+DEBUG = os.environ.get("AE_DEBUG", "0") == "1" # Show full tracebacks in the UI
+logger = logging.getLogger("ae_toolkit")
+
 # --- Page Configuration ---
 st.set_page_config(
     page_title="AE Toolkit",
@@ -15,12 +26,9 @@ st.set_page_config(
 )
 
 # --- Initialize Supabase Client ---
-@st.cache_resource # Use cache_resource for singleton-like behavior
 def init_supabase_client():
     try:
-        supabase_url = st.secrets["SUPABASE_URL"]
-        supabase_key = st.secrets["SUPABASE_KEY"]
-        return create_client(supabase_url, supabase_key)
+        return get_supabase() # Process-level singleton, see supabase_client.py
     except KeyError:
         st.error("Supabase credentials not found. Configure .streamlit/secrets.toml")
         st.stop()
@@ -31,19 +39,15 @@ def init_supabase_client():
 supabase: Client = init_supabase_client()
 
 # --- Helper Functions ---
-def format_currency(amount, currency="SAR"):
-    if amount is None or not isinstance(amount, (int, float)): return "N/A"
-    try:
-        formatted = f"{amount:,.0f}"
-        if currency and not formatted.endswith(currency) and not any(symbol in formatted for symbol in ['SAR', '$', '€', '£']):
-             formatted += f" {currency}"
-        return formatted
-    except (ValueError, TypeError): return "N/A"
+def _fmt_currency_series(s):
+    """Column version of format_currency(x, "") for tables; non-numeric cells become 'N/A'."""
+    return pd.to_numeric(s, errors='coerce').map('{:,.0f}'.format, na_action='ignore').fillna("N/A")
+
+def _fmt_percentage_series(s):
+    """Column version of format_percentage for tables; non-numeric cells become 'N/A'."""
+    return pd.to_numeric(s, errors='coerce').map('{:.1f}%'.format, na_action='ignore').fillna("N/A")
 
-def format_percentage(value):
-    if value is None or not isinstance(value, (int, float)): return "N/A"
-    try: return f"{value:.1f}%"
-    except (ValueError, TypeError): return "N/A"
+_NUMBER_JUNK = str.maketrans('', '', ',%') # Thousands separators and percent signs, dropped in one pass
 
 def clean_number(num_str, is_percentage=False):
     if num_str is None: return 0.0
@@ -51,13 +55,16 @@ def clean_number(num_str, is_percentage=False):
         val = float(num_str)
         # Treat percentage input '5' as 5%, not 0.05% unless it's already < 1
         return val / 100.0 if is_percentage and abs(val) >= 1 else val
-    cleaned = str(num_str).replace(',', '').replace('%', '').strip()
-    if not cleaned: return 0.0
     try:
-        val = float(cleaned)
+        val = float(str(num_str).translate(_NUMBER_JUNK)) # float() ignores surrounding whitespace; '' raises
         return val / 100.0 if is_percentage else val
     except ValueError: return 0.0
 
+def report_exception(context):
+    """Call from an except block: traceback goes to the UI under AE_DEBUG=1, otherwise only to the log."""
+    if DEBUG: st.error(traceback.format_exc())
+    else: logger.exception(context)
+
 # --- Authentication ---
 def show_login_form():
     st.subheader("Login to AE Toolkit")
@@ -71,56 +78,151 @@ def show_login_form():
                 try:
                     response = supabase.auth.sign_in_with_password({"email": email, "password": password})
                     if response.user and response.session:
-                        st.session_state['user'] = response.user.dict()
-                        st.session_state['session'] = response.session.dict()
+                        # Keep only the fields the app reads; the full auth objects are large and re-pickled every rerun
+                        st.session_state['user'] = {'id': response.user.id, 'email': response.user.email}
+                        st.session_state['session'] = {'access_token': response.session.access_token, 'refresh_token': response.session.refresh_token}
                         st.success("Login successful!"); st.rerun()
                     else: st.error("Login failed. Check credentials.")
                 except Exception as e: st.error(f"Login error: Invalid email or password.")
 
+def sign_out_in_background(access_token: str):
+    """Revokes the session server-side on a daemon thread, so logout doesn't wait on the HTTP round-trip."""
+    # Revoke by JWT rather than auth.sign_out(): by the time the thread runs, the shared client may hold another user's session
+    def _sign_out():
+        try: supabase.auth.admin.sign_out(access_token)
+        except Exception: logger.exception("Background sign-out failed")
+    if access_token: threading.Thread(target=_sign_out, daemon=True).start()
+
 # --- Database Functions ---
-def save_deal_bundle_to_db(user_id: str, session_token: str, deals_list: list) -> bool:
-    if not deals_list: st.warning("No deals to save."); return False
-    if not user_id: st.error("Critical Error: User ID missing."); return False
-    if not session_token: st.error("Critical Error: Auth token missing."); return False
-    prepared_deals=[]; skipped_count=0
-    for deal in deals_list:
-        db_deal = { "client_name": deal.get("client_name"), "deal_size": deal.get("deal_size"), "monthly_rate": deal.get("monthly_rate"), "admin_fee": deal.get("admin_fee"), "months": deal.get("months"), "monthly_profit": deal.get("monthly_profit"), "total_profit": deal.get("total_profit"), "admin_fee_amount": deal.get("admin_fee_amount"), "gross_profit": deal.get("gross_profit"), "user_id": user_id }
-        if not all([ db_deal["client_name"], isinstance(db_deal.get("deal_size"), (int, float)) and db_deal["deal_size"] > 0, isinstance(db_deal.get("months"), int) and db_deal["months"] > 0, db_deal["user_id"] is not None ]):
-             st.warning(f"Skipping '{db_deal.get('client_name', 'Unnamed')}' - missing/invalid."); skipped_count += 1; continue
-        prepared_deals.append(db_deal)
-    if not prepared_deals: st.error("No valid deals remaining."); return False
-    if skipped_count > 0: st.warning(f"{skipped_count} deals skipped.")
+INSERT_CHUNK_SIZE = 500 # Rows per INSERT; keeps payloads well under PostgREST/Postgres limits
+PARALLEL_INSERT_THRESHOLD = 2000 # Bundles larger than this insert their chunks concurrently
+DEAL_DB_COLUMNS = ['client_name', 'deal_size', 'monthly_rate', 'admin_fee', 'months', 'monthly_profit', 'total_profit', 'admin_fee_amount', 'gross_profit'] # Staged fields written to `deals` (plus user_id)
+DEALS_PAGE_SIZE = 50 # Saved deals fetched per page
+DEALS_CACHE_TTL = 30 # Seconds before saved deals/summary are re-read from the DB
+SAVED_DEAL_COLUMNS = 'id,created_at,client_name,deal_size,monthly_rate,admin_fee,months,gross_profit' # Only what the Saved Deals table shows
+DEALS_EXPORT_BATCH = 1000 # Rows per request when exporting every deal; PostgREST's default max-rows
+
+def _insert_deal_chunk(db, rows: list):
+    """Inserts one chunk of prepared deals and returns PostgREST's exact row count (None if missing)."""
+    response = db.table('deals').insert(rows, returning='minimal', count='exact').execute()
+    if hasattr(response, 'error') and response.error: raise RuntimeError(f"DB error: {response.error.message if hasattr(response.error, 'message') else response.error}")
+    return response.count
+
+def save_deal_bundle_to_db(user_id: str, session_token: str, deals_list: list) -> tuple:
+    """Inserts the bundle chunk by chunk; returns (positions in deals_list that were persisted, [(level, message), ...]).
+    Runs inside an on_click, where st.* output would land above the page, so messages go back to the caller instead."""
+    notes = []
+    if not deals_list: notes.append(('warning', "No deals to save.")); return [], notes
+    if not user_id: notes.append(('error', "Critical Error: User ID missing.")); return [], notes
+    if not session_token: notes.append(('error', "Critical Error: Auth token missing.")); return [], notes
+    prepared_deals=[]; valid_positions=[]; skipped_count=0
+    for pos, deal in enumerate(deals_list):
+        db_deal = {k: deal.get(k) for k in DEAL_DB_COLUMNS} | {'user_id': user_id}
+        if not all([ db_deal["client_name"], isinstance(db_deal["deal_size"], (int, float)) and db_deal["deal_size"] > 0, isinstance(db_deal["months"], int) and db_deal["months"] > 0 ]):
+            notes.append(('warning', f"Skipping '{db_deal['client_name'] or 'Unnamed'}' - missing/invalid.")); skipped_count += 1; continue
+        prepared_deals.append(db_deal); valid_positions.append(pos)
+    if not prepared_deals: notes.append(('error', "No valid deals remaining.")); return [], notes
+    if skipped_count > 0: notes.append(('warning', f"{skipped_count} deals skipped."))
+    try: db = get_user_db(session_token)
+    except Exception as e:
+        notes.append(('error', f"Exception during bulk save: {e}"))
+        if DEBUG: notes.append(('error', traceback.format_exc())) # report_exception's UI branch, routed through the notes
+        else: logger.exception("Bulk save failed")
+        return [], notes
+    starts = range(0, len(prepared_deals), INSERT_CHUNK_SIZE)
+    def _try_insert(start):
+        # Each chunk commits on its own, so one failure must not hide the chunks already written
+        try: return _insert_deal_chunk(db, prepared_deals[start:start + INSERT_CHUNK_SIZE]), None
+        except Exception as e: logger.exception("Deal chunk insert failed"); return None, e
+    if len(prepared_deals) > PARALLEL_INSERT_THRESHOLD:
+        with ThreadPoolExecutor(max_workers=4) as pool: results = list(pool.map(_try_insert, starts))
+    else: results = [_try_insert(start) for start in starts]
+    saved_positions = [pos for start, (_, err) in zip(starts, results) if err is None for pos in valid_positions[start:start + INSERT_CHUNK_SIZE]]
+    if saved_positions: _invalidate_deal_caches()
+    errors = [err for _, err in results if err is not None]
+    counts = [count for count, err in results if err is None]
+    if errors: notes.append(('error', f"Exception during bulk save: {errors[0]} ({len(saved_positions)}/{len(prepared_deals)} deals were saved)."))
+    elif any(c is None for c in counts): notes.append(('warning', "Saved, but no row count was returned to confirm it."))
+    elif sum(counts) != len(saved_positions): notes.append(('warning', f"Partial success: database confirmed {sum(counts)}/{len(saved_positions)}."))
+    return saved_positions, notes
+
+@st.cache_data(ttl=DEALS_CACHE_TTL, show_spinner=False)
+def _fetch_deals(_db, user_id: str, offset: int = 0) -> list:
+    """Cached query for one page of deals, keyed on user_id + offset (_db, the caller's client, is not hashed). Cleared after every successful save/delete."""
+    response = _db.table('deals').select(SAVED_DEAL_COLUMNS).eq('user_id', user_id).order('created_at', desc=True).range(offset, offset + DEALS_PAGE_SIZE - 1).execute()
+    if hasattr(response, 'error') and response.error: raise RuntimeError(response.error.message) # Errors are not cached
+    return response.data if response.data else []
+
+@st.cache_data(ttl=DEALS_CACHE_TTL, show_spinner=False)
+def _fetch_deal_summary(_db, user_id: str) -> dict:
+    """Cached call to the get_deal_summary RPC (see sql/get_deal_summary.sql); one row regardless of deal count."""
+    response = _db.rpc('get_deal_summary', {'uid': user_id}).execute()
+    if hasattr(response, 'error') and response.error: raise RuntimeError(response.error.message)
+    row = response.data[0] if response.data else {}
+    return {key: float(row.get(key) or 0) for key in ('total_size', 'total_gp', 'avg_rate')} # NULL aggregates (no deals) -> 0
+
+@st.cache_data(ttl=DEALS_CACHE_TTL, show_spinner=False)
+def _fetch_all_deals(_db, user_id: str) -> list:
+    """Every saved deal for the CSV export, read in DEALS_EXPORT_BATCH pages until a short page comes back."""
+    rows = []
+    while True:
+        response = _db.table('deals').select(SAVED_DEAL_COLUMNS).eq('user_id', user_id).order('created_at', desc=True).order('id').range(len(rows), len(rows) + DEALS_EXPORT_BATCH - 1).execute() # 'id' breaks created_at ties so pages don't overlap
+        if hasattr(response, 'error') and response.error: raise RuntimeError(response.error.message)
+        batch = response.data or []; rows.extend(batch)
+        if len(batch) < DEALS_EXPORT_BATCH: return rows
+
+def _invalidate_deal_caches():
+    _fetch_deals.clear(); _fetch_deal_summary.clear(); _fetch_all_deals.clear()
+
+def fetch_deal_summary(user_id: str, session_token: str):
+    if not user_id or not session_token: return None
     try:
-        supabase.auth.set_session(access_token=session_token, refresh_token=st.session_state.get('session',{}).get('refresh_token', 'dummy'))
-        response = supabase.table('deals').insert(prepared_deals).execute()
-        if hasattr(response, 'error') and response.error: error_detail = response.error.message if hasattr(response.error, 'message') else str(response.error); st.error(f"DB error: {error_detail}"); return False
-        elif not response.data: st.error("Bulk save failed: No data returned."); return False
-        elif len(response.data) != len(prepared_deals): st.warning(f"Partial success: Saved {len(response.data)}/{len(prepared_deals)}."); return False
-        else: return True
-    except Exception as e: st.error(f"Exception during bulk save: {e}"); st.error(traceback.format_exc()); return False
-
-def load_deals_from_db(user_id: str, session_token: str):
+        return _fetch_deal_summary(get_user_db(session_token), user_id)
+    except Exception as e: st.warning(f"Cannot load summary: {e}"); return None
+
+def load_deals_from_db(user_id: str, session_token: str, offset: int = 0):
     if not user_id: return []
     if not session_token: st.error("Cannot load: Missing session token."); return []
     try:
-        supabase.auth.set_session(access_token=session_token, refresh_token=st.session_state.get('session',{}).get('refresh_token', 'dummy'))
-        response = supabase.table('deals').select('*').eq('user_id', user_id).order('created_at', desc=True).execute()
-        if hasattr(response, 'error') and response.error: st.error(f"Error loading deals: {response.error.message}"); return []
-        return response.data if response.data else []
+        return _fetch_deals(get_user_db(session_token), user_id, offset)
     except Exception as e: st.error(f"Exception loading deals: {e}"); return []
 
-def delete_deal_from_db(deal_id: str, user_id: str, session_token: str):
-    if not user_id or not deal_id or not session_token: return False
+def load_all_deals_from_db(user_id: str, session_token: str):
+    if not user_id or not session_token: return []
     try:
-        supabase.auth.set_session(access_token=session_token, refresh_token=st.session_state.get('session',{}).get('refresh_token', 'dummy'))
-        response = supabase.table('deals').delete().match({'id': deal_id, 'user_id': user_id}).execute()
-        if hasattr(response, 'error') and response.error: st.error(f"Error deleting deal {deal_id}: {response.error.message}"); return False
-        return True
-    except Exception as e: st.error(f"Exception deleting deal {deal_id}: {e}"); return False
+        return _fetch_all_deals(get_user_db(session_token), user_id)
+    except Exception as e: st.error(f"Exception exporting deals: {e}"); return []
+
+def bulk_delete_deals_from_db(deal_ids: list, user_id: str, session_token: str) -> int:
+    """Deletes all given deals in one request; returns the number of rows removed."""
+    if not user_id or not deal_ids or not session_token: return 0
+    try:
+        response = get_user_db(session_token).table('deals').delete().in_('id', deal_ids).match({'user_id': user_id}).execute()
+        if hasattr(response, 'error') and response.error: st.error(f"Error deleting deals: {response.error.message}"); return 0
+        _invalidate_deal_caches()
+        return len(response.data) if response.data else 0
+    except Exception as e: st.error(f"Exception deleting deals: {e}"); return 0
 
 
 # --- Calculator UI Functions ---
 
+# Credit limit adjustments, applied sequentially: (predicate, factor, reason). Reasons may reference context values.
+_CREDIT_LIMIT_RULES = (
+    # Negative
+    (lambda c: c['exposure_outstanding'] > c['revenue']*0.3, 0.65, "Exposure > 30% Revenue"),
+    (lambda c: c['is_saudi'] == "No", 0.90, "Non-Saudi company"),
+    (lambda c: c['years_of_operation'] < 3, 0.90, "Company < 3 years old"),
+    (lambda c: c['has_concentration'] == "Yes", 0.90, "Customer concentration > 40%"),
+    (lambda c: c['has_previous_payments'] == "Yes" and c['has_payment_delays'] == "Yes", 0.90, "Payment delays > 30 days"),
+    (lambda c: c['number_of_projects'] < 3, 0.95, "Number of Projects < 3"),
+    # Positive
+    (lambda c: c['current_ratio'] > 2, 1.05, "Current Ratio > 2 ({current_ratio:.2f})"),
+    (lambda c: c['years_of_operation'] > 10, 1.05, "Years in Business > 10"),
+    (lambda c: c['has_previous_payments'] == "Yes" and c['has_payment_delays'] == "No", 1.10, "Previous Timely Payments"),
+)
+# Change fragment ('-35%', '+5%', ...) formatted once per rule rather than per calculation
+CREDIT_LIMIT_ADJUSTMENTS = tuple((applies, factor, f"{(factor - 1) * 100:+.0f}%", reason) for applies, factor, reason in _CREDIT_LIMIT_RULES)
+
 def credit_limit_calculator():
     """Renders the Credit Limit Calculator UI and handles calculations."""
     st.header("Credit Limit Calculator")
@@ -207,28 +309,18 @@ def credit_limit_calculator():
             base_limit_after_cap=credit_limit
 
             # <<< FIX: Adjustment Function and Logic >>>
-            def apply_adjustment(current_limit, factor, reason, value_info=""):
+            def apply_adjustment(current_limit, factor, change_str, reason):
                 """Applies adjustment factor and stores formatted detail string."""
-                change_percent = (factor - 1) * 100
                 new_limit = current_limit * factor
-                reason_full = f"{reason} {value_info}".strip()
                 # Format the detail string exactly as needed for output
-                detail_str = f"{reason_full}: {change_percent:+.0f}% ({format_currency(current_limit)} -> {format_currency(new_limit)})"
+                detail_str = f"{reason}: {change_str} ({format_currency(current_limit)} -> {format_currency(new_limit)})"
                 calculation_details["Adjustments"].append(detail_str) # Store the formatted string
                 return new_limit
 
-            # Apply adjustments sequentially
-            # Negative
-            if exposure_outstanding > revenue*0.3: credit_limit=apply_adjustment(credit_limit,0.65,"Exposure > 30% Revenue")
-            if is_saudi=="No": credit_limit=apply_adjustment(credit_limit,0.90,"Non-Saudi company")
-            if years_of_operation<3: credit_limit=apply_adjustment(credit_limit,0.90,"Company < 3 years old")
-            if has_concentration=="Yes": credit_limit=apply_adjustment(credit_limit,0.90,"Customer concentration > 40%")
-            if has_previous_payments=="Yes" and has_payment_delays=="Yes": credit_limit=apply_adjustment(credit_limit,0.90,"Payment delays > 30 days")
-            if number_of_projects<3: credit_limit=apply_adjustment(credit_limit,0.95,"Number of Projects < 3")
-            # Positive (use the calculated actual_current_ratio)
-            if actual_current_ratio > 2: credit_limit=apply_adjustment(credit_limit,1.05,f"Current Ratio > 2",f"({actual_current_ratio:.2f})")
-            if years_of_operation>10: credit_limit=apply_adjustment(credit_limit,1.05,"Years in Business > 10")
-            if has_previous_payments=="Yes" and has_payment_delays=="No": credit_limit=apply_adjustment(credit_limit,1.10,"Previous Timely Payments")
+            # Apply adjustments sequentially (see CREDIT_LIMIT_ADJUSTMENTS for the rule table)
+            adjustment_ctx = {"exposure_outstanding": exposure_outstanding, "revenue": revenue, "is_saudi": is_saudi, "years_of_operation": years_of_operation, "has_concentration": has_concentration, "has_previous_payments": has_previous_payments, "has_payment_delays": has_payment_delays, "number_of_projects": number_of_projects, "current_ratio": actual_current_ratio}
+            for applies, factor, change_str, reason in CREDIT_LIMIT_ADJUSTMENTS:
+                if applies(adjustment_ctx): credit_limit = apply_adjustment(credit_limit, factor, change_str, reason.format_map(adjustment_ctx))
             # <<< END FIX >>>
 
             adjusted_limit=credit_limit
@@ -274,7 +366,7 @@ def credit_limit_calculator():
             # --- <<< END FIX >>> ---
 
         except ZeroDivisionError: st.error("Calc error: Division by zero (Check Current Liabilities).")
-        except Exception as e: st.error(f"Unexpected error: {e}"); st.error(traceback.format_exc())
+        except Exception as e: st.error(f"Unexpected error: {e}"); report_exception("Credit limit calculation failed")
 
     # --- <<< FIX: Display Correct Rules >>> ---
     st.divider()
@@ -305,12 +397,49 @@ def credit_limit_calculator():
     # --- <<< END FIX >>> ---
 
 
+@st.cache_data(max_entries=8, show_spinner=False)
+def _deals_csv_bytes(df) -> bytes:
+    """CSV export of the displayed deals. Cached on the frame's contents, so reruns reuse the bytes."""
+    buf = io.BytesIO()
+    df.to_csv(buf, index=False, encoding='utf-8', chunksize=1000) # Written straight into the byte buffer, no intermediate str
+    return buf.getvalue()
+
+SAVED_DEAL_DISPLAY_COLS = ['Saved On','Client Name','Deal Size (SAR)','Monthly Rate','Admin Fee %','Months','Gross Profit (SAR)']
+
+def _saved_deals_display(deals_df):
+    """Formatted Saved Deals frame (SAVED_DEAL_DISPLAY_COLS + 'id'), shared by the editor and the CSV export."""
+    return pd.DataFrame({
+        'Saved On': deals_df['created_at'].str.slice(0,16).str.replace('T',' ',regex=False), # ISO 'YYYY-MM-DDTHH:MM...' -> 'YYYY-MM-DD HH:MM', no datetime parse
+        'Client Name': deals_df['client_name'],
+        'Deal Size (SAR)': _fmt_currency_series(deals_df['deal_size']),
+        'Monthly Rate': _fmt_percentage_series(deals_df['monthly_rate']),
+        'Admin Fee %': _fmt_percentage_series(deals_df['admin_fee']),
+        'Months': pd.to_numeric(deals_df['months'],errors='coerce').fillna(0).astype(int),
+        'Gross Profit (SAR)': _fmt_currency_series(deals_df['gross_profit']),
+        'id': deals_df['id'],
+    })
+
+def _save_staged_deals(user_id, session_token):
+    """on_click for the save button. Runs before the script, so this same run draws the updated staging area without an extra st.rerun()."""
+    staged = st.session_state.get('unsaved_deals', {})
+    temp_ids = list(staged); current_staged_deals = list(staged.values())
+    num_to_save = len(current_staged_deals)
+    if num_to_save == 0: st.session_state['_save_flash'] = [('warning', "No deals in staging to save.")]; return
+    if not session_token: st.session_state['_save_flash'] = [('error', "Session token missing.")]; return
+    with st.spinner(f"Saving {num_to_save} deals..."): saved_positions, notes = save_deal_bundle_to_db(user_id, session_token, current_staged_deals)
+    for pos in saved_positions: staged.pop(temp_ids[pos]) # Only what reached the DB leaves staging, so a retry can't duplicate it
+    if saved_positions: st.session_state.pop('_saved_df', None)
+    if len(saved_positions) == num_to_save: outcome = ('success', f"Saved {num_to_save} deals.")
+    elif saved_positions: outcome = ('warning', f"Saved {len(saved_positions)}/{num_to_save} deals. The rest remain staged.")
+    else: outcome = ('error', "Failed to save bundle. Deals remain staged.")
+    st.session_state['_save_flash'] = notes + [outcome] # Drawn in the staging area by profit_calculator
+
 # --- profit_calculator Function ---
 # (Keep the previously corrected version - no changes requested here)
 def profit_calculator(user_id, session_token):
     st.header("Profitability Calculator")
     st.caption("Add deals to staging, calculate staged profit, save bundle. View/manage saved deals.")
-    if 'unsaved_deals' not in st.session_state: st.session_state.unsaved_deals = []
+    st.session_state.setdefault('unsaved_deals', {}) # temp_id -> staged deal
     with st.expander("Add New Deal to Staging", expanded=True):
         with st.form("add_deal_form", clear_on_submit=False): # Keep form populated
             c1,c2,c3=st.columns(3);
@@ -321,30 +450,41 @@ def profit_calculator(user_id, session_token):
             if submitted:
                 if not client_name or deal_size<=0: st.warning("Client & Size required.")
                 else:
-                    monthly_profit=deal_size*(monthly_rate/100.0); total_profit=monthly_profit*months; admin_fee_amount=deal_size*(admin_fee_perc/100.0); gross_profit=total_profit+admin_fee_amount; temp_id=datetime.datetime.now().isoformat()+"_"+client_name.replace(" ","_")
+                    monthly_profit=deal_size*(monthly_rate/100.0); total_profit=monthly_profit*months; admin_fee_amount=deal_size*(admin_fee_perc/100.0); gross_profit=total_profit+admin_fee_amount
+                    # Per-session counter: unique even for same-tick adds, and survives reruns unlike a module-level counter
+                    temp_id=f"t{st.session_state.get('_next_temp_id', 0)}"; st.session_state['_next_temp_id']=st.session_state.get('_next_temp_id', 0)+1
                     new_deal={"temp_id":temp_id,"client_name":client_name,"deal_size":deal_size,"monthly_rate":monthly_rate,"admin_fee":admin_fee_perc,"months":months,"monthly_profit":monthly_profit,"total_profit":total_profit,"admin_fee_amount":admin_fee_amount,"gross_profit":gross_profit}
-                    st.session_state.unsaved_deals.append(new_deal)
+                    st.session_state.unsaved_deals[temp_id] = new_deal; st.session_state['_staged_sig'] = None
                     st.success(f"Deal '{client_name}' staged. Modify inputs to add another.")
     st.divider()
     st.subheader("Unsaved Deals (Staging Area)")
-    unsaved_deals_list = st.session_state.get('unsaved_deals', [])
-    if not unsaved_deals_list: st.info("No deals currently staged.")
+    for level, message in st.session_state.pop('_save_flash', []): getattr(st, level)(message) # Messages from the save callback on the previous click
+    staged_deals = st.session_state.get('unsaved_deals', {})
+    if not staged_deals: st.info("No deals currently staged.")
     else:
-        unsaved_df = pd.DataFrame(unsaved_deals_list)
-        display_unsaved_df = unsaved_df[['temp_id', 'client_name', 'deal_size', 'monthly_rate', 'admin_fee', 'months', 'gross_profit']].copy()
-        display_unsaved_df['Deal Size (SAR)']=display_unsaved_df['deal_size'].apply(lambda x: format_currency(x,"")); display_unsaved_df['Monthly Rate']=display_unsaved_df['monthly_rate'].apply(format_percentage); display_unsaved_df['Admin Fee %']=display_unsaved_df['admin_fee'].apply(format_percentage); display_unsaved_df['Gross Profit (SAR)']=display_unsaved_df['gross_profit'].apply(lambda x: format_currency(x,"")); display_unsaved_df['Months']=display_unsaved_df['months'].astype(int);display_unsaved_df['Client Name']=display_unsaved_df['client_name']
-        display_unsaved_df['Remove']=False
+        # Reuse the formatted frames until the set of staged deals changes
+        staged_sig = hash(tuple(staged_deals))
         unsaved_editor_cols = ['Client Name', 'Deal Size (SAR)', 'Monthly Rate', 'Admin Fee %', 'Months', 'Gross Profit (SAR)', 'Remove']
+        if st.session_state.get('_staged_sig') == staged_sig:
+            unsaved_df = st.session_state['_staged_df']; display_unsaved_df = st.session_state['_staged_display_df']
+        else:
+            unsaved_df = pd.DataFrame.from_records(list(staged_deals.values()), index=list(staged_deals)) # Indexed by temp_id, so editor rows map straight back to keys
+            display_unsaved_df = unsaved_df[['temp_id', 'client_name', 'deal_size', 'monthly_rate', 'admin_fee', 'months', 'gross_profit']].copy()
+            display_unsaved_df['Deal Size (SAR)']=_fmt_currency_series(display_unsaved_df['deal_size']); display_unsaved_df['Monthly Rate']=_fmt_percentage_series(display_unsaved_df['monthly_rate']); display_unsaved_df['Admin Fee %']=_fmt_percentage_series(display_unsaved_df['admin_fee']); display_unsaved_df['Gross Profit (SAR)']=_fmt_currency_series(display_unsaved_df['gross_profit']); display_unsaved_df['Months']=display_unsaved_df['months'].astype(int);display_unsaved_df['Client Name']=display_unsaved_df['client_name']
+            display_unsaved_df['Remove']=False
+            display_unsaved_df = display_unsaved_df[unsaved_editor_cols] # Only the shown columns are cached and sent to the browser; index stays temp_id
+            st.session_state['_staged_sig'] = staged_sig; st.session_state['_staged_df'] = unsaved_df; st.session_state['_staged_display_df'] = display_unsaved_df
         with st.form("remove_staged_deals_form"):
             st.write("Review staged deals. Select 'Remove' checkbox and submit below.")
-            edited_unsaved_df = st.data_editor(display_unsaved_df[unsaved_editor_cols], column_config={"Remove": st.column_config.CheckboxColumn("Remove?", default=False)}, disabled=['Client Name', 'Deal Size (SAR)', 'Monthly Rate', 'Admin Fee %', 'Months', 'Gross Profit (SAR)'], use_container_width=True, hide_index=True, key="unsaved_deals_editor")
+            st.data_editor(display_unsaved_df, column_config={"Remove": st.column_config.CheckboxColumn("Remove?", default=False)}, disabled=['Client Name', 'Deal Size (SAR)', 'Monthly Rate', 'Admin Fee %', 'Months', 'Gross Profit (SAR)'], num_rows="fixed", use_container_width=True, hide_index=True, key="unsaved_deals_editor")
             remove_button = st.form_submit_button("Remove Selected Staged Deals")
             if remove_button:
-                selected_to_remove_indices = edited_unsaved_df[edited_unsaved_df['Remove'] == True].index
-                if not selected_to_remove_indices.empty:
-                    temp_ids_to_remove = unsaved_df.loc[selected_to_remove_indices, 'temp_id'].tolist()
-                    st.session_state.unsaved_deals = [d for d in unsaved_deals_list if d.get('temp_id') not in temp_ids_to_remove]
-                    st.success(f"Removed {len(temp_ids_to_remove)} deals."); st.rerun()
+                # Read the editor's delta ({row position: {column: value}}) rather than scanning the returned frame
+                temp_ids_to_remove = [display_unsaved_df.index[pos] for pos, change in st.session_state["unsaved_deals_editor"]["edited_rows"].items() if change.get('Remove')]
+                if temp_ids_to_remove:
+                    for temp_id in temp_ids_to_remove: staged_deals.pop(temp_id, None)
+                    st.session_state['_staged_sig'] = None
+                    st.success(f"Removed {len(temp_ids_to_remove)} deals."); st.rerun() # Editor above was drawn with the removed rows
                 else: st.warning("No deals selected for removal.")
         st.write("**Staging Area Summary:**")
         if not unsaved_df.empty:
@@ -355,127 +495,144 @@ def profit_calculator(user_id, session_token):
             with summary_cols_staged[1]: st.metric("Total Staged Gross Profit", format_currency(staged_total_gp))
         else: st.info("Add deals to see staging summary.")
         st.divider()
-        if st.button("Save All Staged Deals to Database", type="primary", key="save_bundle_btn"):
-            current_staged_deals = st.session_state.get('unsaved_deals', [])
-            num_to_save = len(current_staged_deals)
-            if num_to_save > 0:
-                if not session_token: st.error("Session token missing.")
-                else:
-                    with st.spinner(f"Saving {num_to_save} deals..."): success = save_deal_bundle_to_db(user_id, session_token, current_staged_deals)
-                    if success: st.success(f"Saved {num_to_save} deals."); st.session_state.unsaved_deals = []; st.rerun()
-                    else: st.error("Failed to save bundle. Deals remain staged.")
-            else: st.warning("No deals in staging to save.")
+        st.button("Save All Staged Deals to Database", type="primary", key="save_bundle_btn", on_click=_save_staged_deals, args=(user_id, session_token))
     st.divider()
     st.subheader("Saved Deals (From Database)")
     if not session_token: st.warning("Session token missing. Cannot load.")
     else:
-        with st.spinner("Loading saved deals..."): saved_deals_data = load_deals_from_db(user_id, session_token)
-        if not saved_deals_data: st.info("No deals saved yet.")
+        page_col, _ = st.columns([0.15, 0.85])
+        with page_col: page = st.number_input("Page", min_value=1, value=1, step=1, key="saved_deals_page")
+        offset = (int(page) - 1) * DEALS_PAGE_SIZE
+        # The prepared frame is kept per session so deletes can be applied locally instead of refetching
+        saved_cache = st.session_state.get('_saved_df')
+        if saved_cache and saved_cache['key'] == (user_id, offset) and time.monotonic() - saved_cache['loaded_at'] < DEALS_CACHE_TTL:
+            deals_df = saved_cache['df']
         else:
-            try:
-                deals_df = pd.DataFrame(saved_deals_data)
-                if deals_df.empty: st.info("No deals data found."); return
-                required_summary_cols = ['deal_size', 'gross_profit', 'monthly_rate']
-                if not all(col in deals_df.columns for col in required_summary_cols): st.error("Loaded data missing summary columns."); return
+            with st.spinner("Loading saved deals..."): saved_deals_data = load_deals_from_db(user_id, session_token, offset)
+            deals_df = pd.DataFrame(saved_deals_data)
+            if not deals_df.empty and all(col in deals_df.columns for col in ['deal_size', 'gross_profit', 'monthly_rate']):
                 deals_df['deal_size'] = pd.to_numeric(deals_df['deal_size'], errors='coerce').fillna(0)
                 deals_df['gross_profit'] = pd.to_numeric(deals_df['gross_profit'], errors='coerce').fillna(0)
                 deals_df['monthly_rate'] = pd.to_numeric(deals_df['monthly_rate'], errors='coerce')
-                required_display_cols=['id','created_at','client_name','deal_size','monthly_rate','admin_fee','months','gross_profit']
-                if not all(col in deals_df.columns for col in required_display_cols): st.error("Loaded data missing display columns."); return
-                display_df=deals_df[required_display_cols].copy()
-                display_df['Saved On']=pd.to_datetime(display_df['created_at']).dt.strftime('%Y-%m-%d %H:%M')
-                display_df['Deal Size (SAR)']=deals_df['deal_size'].apply(lambda x: format_currency(x,"") if pd.notna(x) else "N/A")
-                display_df['Monthly Rate']=deals_df['monthly_rate'].apply(lambda x: format_percentage(x) if pd.notna(x) else "N/A")
-                display_df['Admin Fee %']=pd.to_numeric(deals_df['admin_fee'], errors='coerce').apply(lambda x: format_percentage(x) if pd.notna(x) else "N/A")
-                display_df['Gross Profit (SAR)']=deals_df['gross_profit'].apply(lambda x: format_currency(x,"") if pd.notna(x) else "N/A")
-                display_df['Months']=pd.to_numeric(deals_df['months'],errors='coerce').fillna(0).astype(int)
-                display_df['Client Name']=deals_df['client_name']
-                editor_cols=['Saved On','Client Name','Deal Size (SAR)','Monthly Rate','Admin Fee %','Months','Gross Profit (SAR)']
-                display_for_editor=display_df[editor_cols].copy();display_for_editor['Delete']=False
+                st.session_state['_saved_df'] = {'key': (user_id, offset), 'loaded_at': time.monotonic(), 'df': deals_df}
+        if deals_df.empty: st.info("No deals saved yet." if offset == 0 else "No deals on this page.")
+        else:
+            try:
+                required_summary_cols = ['deal_size', 'gross_profit', 'monthly_rate']
+                if not all(col in deals_df.columns for col in required_summary_cols): st.error("Loaded data missing summary columns."); return
+                editor_cols=SAVED_DEAL_DISPLAY_COLS
+                editor_df=_saved_deals_display(deals_df).assign(Delete=False) # 'id' rides along for delete lookups but is hidden via column_order
                 with st.form("delete_saved_deals_form"):
                     st.write("View/select saved deals to delete:")
-                    edited_df=st.data_editor(display_for_editor,column_config={"Delete":st.column_config.CheckboxColumn("Del?",default=False)},disabled=editor_cols,use_container_width=True,hide_index=True,key="saved_deals_editor")
+                    st.data_editor(editor_df,column_order=editor_cols+['Delete'],column_config={"Delete":st.column_config.CheckboxColumn("Del?",default=False)},disabled=editor_cols+['id'],num_rows="fixed",use_container_width=True,hide_index=True,key="saved_deals_editor")
                     delete_button=st.form_submit_button("Delete Selected Saved")
                     if delete_button:
-                        selected_indices=edited_df[edited_df['Delete']==True].index
-                        if not selected_indices.empty:
-                            deals_to_delete_ids=deals_df.loc[selected_indices,'id'].tolist()
+                        selected_positions=[pos for pos,change in st.session_state["saved_deals_editor"]["edited_rows"].items() if change.get('Delete')] # Editor delta, see staging form
+                        if selected_positions:
+                            deals_to_delete_ids=editor_df['id'].iloc[selected_positions].tolist()
                             deleted_count=0;total_to_delete=len(deals_to_delete_ids)
-                            with st.spinner(f"Deleting {total_to_delete}..."):results=[delete_deal_from_db(did,user_id,session_token) for did in deals_to_delete_ids];deleted_count=sum(results)
+                            with st.spinner(f"Deleting {total_to_delete}..."):deleted_count=bulk_delete_deals_from_db(deals_to_delete_ids,user_id,session_token)
                             if deleted_count>0: st.success(f"Deleted {deleted_count}/{total_to_delete}.")
-                            if deleted_count<total_to_delete: st.warning(f"Failed to delete {total_to_delete-deleted_count}.")
-                            st.rerun()
+                            if deleted_count<total_to_delete: st.warning(f"Failed to delete {total_to_delete-deleted_count}."); st.session_state.pop('_saved_df', None) # Unknown which failed: refetch
+                            elif '_saved_df' in st.session_state: st.session_state['_saved_df']['df'] = deals_df[~deals_df['id'].isin(deals_to_delete_ids)].reset_index(drop=True)
+                            st.rerun() # Redraws from the locally updated frame, no Supabase round-trip
                         else: st.warning("No deals selected.")
                 st.divider()
                 st.subheader("Summary of Saved Deals")
-                if all(col in deals_df.columns for col in ['deal_size', 'gross_profit', 'monthly_rate']):
-                     total_saved_deal_size = deals_df['deal_size'].sum(skipna=True)
-                     total_saved_gross_profit = deals_df['gross_profit'].sum(skipna=True)
-                     average_saved_monthly_rate = deals_df['monthly_rate'].mean(skipna=True) if deals_df['monthly_rate'].notna().any() else 0
+                deal_summary = fetch_deal_summary(user_id, session_token) # Aggregated server-side, not from deals_df
+                if deal_summary:
                      summary_cols=st.columns(3)
-                     with summary_cols[0]: st.metric("Total Deal Size (Saved)", format_currency(total_saved_deal_size))
-                     with summary_cols[1]: st.metric("Total Gross Profit (Saved)", format_currency(total_saved_gross_profit))
-                     with summary_cols[2]: st.metric("Avg Monthly Rate (Saved)", format_percentage(average_saved_monthly_rate))
-                else: st.warning("Cannot calculate summary - cols missing.")
-                csv_data = display_for_editor.drop(columns=['Delete']).to_csv(index=False).encode('utf-8')
-                st.download_button("Download Saved Deals as CSV", csv_data, 'ae_saved_deals.csv', 'text/csv')
-            except Exception as e: st.error(f"Error processing saved deals: {e}"); st.error(traceback.format_exc())
+                     with summary_cols[0]: st.metric("Total Deal Size (Saved)", format_currency(deal_summary['total_size']))
+                     with summary_cols[1]: st.metric("Total Gross Profit (Saved)", format_currency(deal_summary['total_gp']))
+                     with summary_cols[2]: st.metric("Avg Monthly Rate (Saved)", format_percentage(deal_summary['avg_rate']))
+                # The table is paginated, so the export fetches every deal, and only when asked
+                if st.button("Prepare CSV of All Saved Deals", key="export_all_btn"):
+                    with st.spinner("Loading all saved deals..."): all_deals = load_all_deals_from_db(user_id, session_token)
+                    if all_deals: st.download_button(f"Download All {len(all_deals)} Saved Deals as CSV", _deals_csv_bytes(_saved_deals_display(pd.DataFrame(all_deals))[SAVED_DEAL_DISPLAY_COLS]), 'ae_saved_deals.csv', 'text/csv')
+            except Exception as e: st.error(f"Error processing saved deals: {e}"); report_exception("Processing saved deals failed")
 
 
 # --- murabahah_calculator Function ---
 # (Keep the previously corrected version)
+MURABAHAH_FORMAT_COLS = ("Installment (SAR)","Principal (SAR)","Profit (SAR)","Admin Fee Paid (SAR)","Remaining Principal (SAR)") # Every amount column of the schedule
+# Formatted client-side by the grid (thousands separators); values arrive rounded to whole SAR
+MURABAHAH_COLUMN_CONFIG = {c: st.column_config.NumberColumn(format="localized") for c in MURABAHAH_FORMAT_COLS}
+HALALAS_PER_SAR = 100
+
+def _amortize(deal_h, rate, n, admin_h, base_h):
+    """Schedule kernel in integer halalas: (installments, principal, profit, admin fee paid, remaining) int64 arrays for n months."""
+    # Closed form of the recurrence R[m] = R[m-1]*(1+r) - base (profit on declining principal, equal base payments)
+    months = np.arange(1, n + 1)
+    growth = np.power(1.0 + rate, months)
+    if rate > 0: closing = deal_h * growth - base_h * (growth - 1.0) / rate
+    else: closing = deal_h - base_h * months.astype(np.float64)
+    # Balance vector [deal, R1, ..., Rn]: quantized once, and the final month closes the deal
+    balances = np.empty(n + 1, dtype=np.int64); balances[0] = deal_h; balances[1:] = np.rint(closing).astype(np.int64); balances[n] = 0
+    principal = -np.diff(balances) # Exact in integers: sums to deal_h, so no residual patch for the last month
+    profit = np.rint(balances[:-1] * rate).astype(np.int64) # On the opening balance of each month
+    admin_paid = np.zeros(n, dtype=np.int64); admin_paid[0] = admin_h
+    return base_h + admin_paid, principal, profit, admin_paid, np.maximum(balances[1:], 0)
+
+@st.cache_data(max_entries=128, show_spinner=False)
+def _compute_murabahah(deal_size, profit_rate_dec, financing_period, admin_fee_dec):
+    """Pure schedule math, memoized on the four inputs (rates as decimals, 0.025 = 2.5%). Returns (schedule_df, totals)."""
+    # O(1) closed-form totals, quantized to integer halalas once
+    deal_h = round(deal_size * HALALAS_PER_SAR)
+    admin_h = round(deal_h * admin_fee_dec)
+    total_profit_h = round(deal_h * profit_rate_dec * financing_period)
+    base_h = round((deal_h + total_profit_h) / financing_period)
+    columns = _amortize(deal_h, profit_rate_dec, financing_period, admin_h, base_h)
+    # Built from column arrays with fixed dtypes (int32 month, float64 SAR amounts) - no per-row dicts or dtype inference
+    # Math stays in halalas; only the displayed amounts are rounded to whole SAR, matching the old "{:,.0f}"
+    schedule_df = pd.DataFrame({"Month": np.arange(1, financing_period + 1, dtype=np.int32), **{col: np.rint(values / HALALAS_PER_SAR) for col, values in zip(MURABAHAH_FORMAT_COLS, columns)}})
+    totals = {"first": (base_h + admin_h) / HALALAS_PER_SAR, "subsequent": base_h / HALALAS_PER_SAR, "total_profit": total_profit_h / HALALAS_PER_SAR, "total_earnings": (total_profit_h + admin_h) / HALALAS_PER_SAR}
+    return schedule_df, totals
+
+_EMPTY_MURABAHAH = (pd.DataFrame(), {"first": 0, "subsequent": 0, "total_profit": 0, "total_earnings": 0}) # Shown when inputs can't be computed
+
+def _read_murabahah_inputs():
+    """Input widgets; returns keyword arguments for _compute_murabahah. Sliders show percent, rates leave here as decimals."""
+    deal_size = st.number_input("Deal Size (SAR)", min_value=0.01, value=100000.0, step=10000.0, format="%.0f", key="mur_deal_size")
+    profit_rate = st.slider("Monthly Profit Rate (%)", 1.0, 5.0, 2.5, 0.1, format="%.1f%%", key="mur_profit_rate")
+    financing_period = int(st.slider("Financing Period (Months)", 1.0, 12.0, 3.0, 1.0, key="mur_period"))
+    admin_fee_perc = st.slider("Administrative Fee (%)", 0.0, 5.0, 1.5, 0.1, format="%.1f%%", key="mur_admin_fee")
+    return {"deal_size": deal_size, "profit_rate_dec": profit_rate * 0.01, "financing_period": financing_period, "admin_fee_dec": admin_fee_perc * 0.01}
+
+def _render_murabahah_metrics(totals):
+    # One markdown element instead of a 4-column layout holding 4 metrics: a single delta per rerun
+    st.markdown(
+        "| First Month Payment | Subsequent Payments | Total Profit | Total Earnings |\n|:---:|:---:|:---:|:---:|\n"
+        f"| **{format_currency(totals['first'])}** | **{format_currency(totals['subsequent'])}** | **{format_currency(totals['total_profit'])}** | **{format_currency(totals['total_earnings'])}** |"
+    )
+
+def _render_murabahah_schedule(schedule_df):
+    st.write("")
+    st.write("**Payment Schedule**")
+    if not schedule_df.empty:
+        st.dataframe(schedule_df,column_config=MURABAHAH_COLUMN_CONFIG,hide_index=True,use_container_width=True)
+    else: st.info("Enter positive Deal Size & Period.")
+
+@st.fragment # Slider/input changes rerun only this tab, not the whole page
 def murabahah_calculator():
     st.header("Murabahah Size Calculator")
     st.caption("Calculate profitability and payment schedule (Admin fee paid in Month 1).")
     st.subheader("Inputs")
-    deal_size = st.number_input("Deal Size (SAR)", min_value=0.01, value=100000.0, step=10000.0, format="%.0f", key="mur_deal_size")
-    profit_rate = st.slider("Monthly Profit Rate (%)", 1.0, 5.0, 2.5, 0.1, format="%.1f%%", key="mur_profit_rate")
-    financing_period_float = st.slider("Financing Period (Months)", 1.0, 12.0, 3.0, 1.0, key="mur_period")
-    financing_period = int(financing_period_float)
-    admin_fee_perc = st.slider("Administrative Fee (%)", 0.0, 5.0, 1.5, 0.1, format="%.1f%%", key="mur_admin_fee")
+    inputs = _read_murabahah_inputs()
     st.divider()
     st.subheader("Murabahah Summary & Schedule")
-    total_profit = 0; total_admin_fee = 0; total_earnings = 0
-    first_month_payment = 0; subsequent_monthly_payment = 0
-    payment_schedule_df = pd.DataFrame()
-    if deal_size > 0 and financing_period > 0:
-        try:
-            admin_fee_amount = deal_size * (admin_fee_perc / 100.0)
-            monthly_profit_rate_dec = profit_rate / 100.0
-            total_profit_amount = deal_size * monthly_profit_rate_dec * financing_period
-            total_earnings = total_profit_amount + admin_fee_amount
-            total_admin_fee = admin_fee_amount
-            base_repayment_per_month = (deal_size + total_profit_amount) / financing_period if financing_period > 0 else 0
-            first_month_payment = base_repayment_per_month + admin_fee_amount
-            subsequent_monthly_payment = base_repayment_per_month
-            schedule = []; remaining_principal = deal_size
-            for month in range(1, financing_period + 1):
-                 profit_for_month = remaining_principal * monthly_profit_rate_dec
-                 current_month_total_payment = first_month_payment if month == 1 else subsequent_monthly_payment
-                 admin_fee_paid_this_month = admin_fee_amount if month == 1 else 0
-                 principal_paid = max(0, current_month_total_payment - profit_for_month - admin_fee_paid_this_month)
-                 if month == financing_period: principal_paid = remaining_principal
-                 remaining_principal -= principal_paid
-                 schedule.append({"Month": month,"Installment (SAR)": current_month_total_payment,"Principal (SAR)": principal_paid,"Profit (SAR)": profit_for_month,"Admin Fee Paid (SAR)": admin_fee_paid_this_month,"Remaining Principal (SAR)": max(0, remaining_principal)})
-            if schedule: payment_schedule_df = pd.DataFrame(schedule)
+    # Compute (cached) once, then render; invalid or failed inputs fall back to the empty result
+    schedule_df, totals = _EMPTY_MURABAHAH
+    if inputs["deal_size"] > 0 and inputs["financing_period"] > 0:
+        try: schedule_df, totals = _compute_murabahah(**inputs)
         except Exception as e: st.error(f"Error in Murabahah calc: {e}")
-    summary_cols = st.columns(4)
-    with summary_cols[0]: st.metric("First Month Payment", format_currency(first_month_payment))
-    with summary_cols[1]: st.metric("Subsequent Payments", format_currency(subsequent_monthly_payment))
-    with summary_cols[2]: st.metric("Total Profit", format_currency(total_profit))
-    with summary_cols[3]: st.metric("Total Earnings", format_currency(total_earnings), delta_color="off")
-    st.write("")
-    st.write("**Payment Schedule**")
-    if not payment_schedule_df.empty:
-        format_cols=["Installment (SAR)","Principal (SAR)","Profit (SAR)","Admin Fee Paid (SAR)","Remaining Principal (SAR)"]
-        st.dataframe(payment_schedule_df.style.format("{:,.0f}",subset=[c for c in format_cols if c in payment_schedule_df]),hide_index=True,use_container_width=True)
-    else: st.info("Enter positive Deal Size & Period.")
+    _render_murabahah_metrics(totals)
+    _render_murabahah_schedule(schedule_df)
 
 # --- Main Application Flow ---
 # (Initialization and Auth Check remain the same)
 if 'user' not in st.session_state: st.session_state['user'] = None
 if 'session' not in st.session_state: st.session_state['session'] = None
-if 'unsaved_deals' not in st.session_state: st.session_state['unsaved_deals'] = []
+if 'unsaved_deals' not in st.session_state: st.session_state['unsaved_deals'] = {}
 
 if not st.session_state.user or not st.session_state.session:
     show_login_form()
@@ -489,7 +646,7 @@ else:
     with header_cols[1]:
         if st.button("Logout", key="logout_btn"):
             try:
-                supabase.auth.sign_out(); keys_to_clear=list(st.session_state.keys()); [st.session_state.pop(key) for key in keys_to_clear]
+                sign_out_in_background(access_token); st.session_state.clear()
                 st.success("Logged out."); st.rerun()
             except Exception as e: st.error(f"Logout error: {e}")
     # Main Content Check
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+"""Scalar display formatters used by the metrics and breakdown text."""
+from functools import lru_cache
+
+@lru_cache(maxsize=1024) # Metrics re-format the same few values on nearly every rerun
+def format_currency(amount, currency="SAR"):
+    if amount is None or not isinstance(amount, (int, float)): return "N/A"
+    try:
+        formatted = f"{amount:,.0f}"
+        if currency and not formatted.endswith(currency) and not any(symbol in formatted for symbol in ['SAR', '$', '€', '£']):
+             formatted += f" {currency}"
+        return formatted
+    except (ValueError, TypeError): return "N/A"
+
+def format_percentage(value):
+    if value is None or not isinstance(value, (int, float)): return "N/A"
+    try: return f"{value:.1f}%"
+    except (ValueError, TypeError): return "N/A"
@@ -0,0 +1,8 @@
+-- Aggregates for the "Summary of Saved Deals" metrics, called via supabase.rpc('get_deal_summary', {'uid': ...}).
+-- SECURITY INVOKER (the default) keeps the deals table's row-level security in force.
+CREATE OR REPLACE FUNCTION get_deal_summary(uid uuid)
+RETURNS TABLE(total_size numeric, total_gp numeric, avg_rate numeric)
+LANGUAGE sql STABLE
+AS $$
+    SELECT sum(deal_size), sum(gross_profit), avg(monthly_rate) FROM deals WHERE user_id = uid
+$$;
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+"""Process-wide Supabase client shared by every Streamlit session."""
+import threading
+from functools import lru_cache
+import httpx
+import streamlit as st
+from supabase import create_client, Client
+from postgrest import SyncPostgrestClient
+from supabase import ClientOptions # Sync options class; the base class in supabase.lib.client_options has no httpx_client from 2.24 on
+
+_SUPABASE: Client | None = None
+_HTTP: httpx.Client | None = None # Connection pool shared by the Supabase client and every per-user PostgREST client
+_LOCK = threading.Lock()
+
+def get_supabase() -> Client:
+    """Returns the shared client, building it on first use. Raises KeyError if secrets are missing."""
+    global _SUPABASE, _HTTP
+    if _SUPABASE is None:
+        with _LOCK:
+            if _SUPABASE is None:
+                # HTTP/2 + keep-alive pool so DB calls reuse one TLS connection; the cap bounds connections to Supabase
+                # Timeout lives on the client itself: ClientOptions' per-service timeouts are ignored once httpx_client is passed
+                _HTTP = httpx.Client(http2=True, timeout=10, limits=httpx.Limits(max_connections=20, max_keepalive_connections=20, keepalive_expiry=60))
+                options = ClientOptions(httpx_client=_HTTP)
+                _SUPABASE = create_client(st.secrets["SUPABASE_URL"], st.secrets["SUPABASE_KEY"], options=options)
+    return _SUPABASE
+
+@lru_cache(maxsize=256)
+def get_user_db(access_token: str) -> SyncPostgrestClient:
+    """PostgREST client that always sends this JWT. Sessions never swap auth on a shared client, but all reuse its connection pool."""
+    get_supabase() # Builds the shared pool on first use
+    return SyncPostgrestClient(f"{st.secrets['SUPABASE_URL']}/rest/v1", headers={"apikey": st.secrets["SUPABASE_KEY"], "Authorization": f"Bearer {access_token}"}, http_client=_HTTP)